@@ -0,0 +1,378 @@
+import contextlib
+import io
+import uuid
+
+import pytest
+from django.apps import apps
+from django.db import connection, models
+from django.db.migrations.state import ProjectState
+
+import uuid_migration_utils
+from uuid_migration_utils import (
+    _any_implicit_m2m,
+    _child_fk_swap_sql,
+    _copy_to_temp_table,
+    _fk_uuid_update_sql,
+    _iter_implicit_m2m,
+    _random_uuid_bytes,
+    _SwapForeignKeyToUUID,
+    create_uuid_migration,
+    find_related_models,
+    generate_through_model_code,
+    generate_uuid_for_model,
+)
+
+# Подсказка для миграции в том виде, в котором ее выдавала исходная версия модуля
+EXPECTED_MIGRATION_HINT = """
+# ВАЖНО: Простое изменение модели и создание обычной миграции НЕ СРАБОТАЕТ
+# Вместо этого после создания through-модели ParentOtherThrough:
+# 1. Создайте миграцию: python manage.py makemigrations
+# 2. ОТРЕДАКТИРУЙТЕ файл миграции, заменив его содержимое на:
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('testapp', 'XXXX_previous_migration'),  # Укажите предыдущую миграцию
+    ]
+
+    state_operations = [
+        migrations.CreateModel(
+            name='ParentOtherThrough',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('parent', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='testapp.Parent', db_index=True)),
+                ('other', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='testapp.Other', db_index=True)),
+                # Дополнительные поля модели здесь
+            ],
+        ),
+        # Указываем Django использовать существующую таблицу для новой модели
+        migrations.AlterModelTable(
+            name='parentotherthrough',
+            table='testapp_parent_others',  # Имя автоматически созданной m2m таблицы
+        ),
+        # Меняем состояние модели для использования through
+        migrations.AlterField(
+            model_name='parent',
+            name='others',
+            field=models.ManyToManyField(through='testapp.ParentOtherThrough', to='testapp.Other'),
+        ),
+    ]
+
+    operations = [
+        # Обновляем только состояние Django, но не базу данных
+        migrations.SeparateDatabaseAndState(state_operations=state_operations),
+        # Добавляем необходимые дополнительные поля в существующую таблицу
+        # migrations.AddField(
+        #     model_name='ParentOtherThrough',
+        #     name='some_extra_field',
+        #     field=models.CharField(max_length=100, null=True),
+        # ),
+        # Возвращаем имя таблицы в нормальное состояние
+        migrations.AlterModelTable(
+            name='parentotherthrough',
+            table=None,
+        ),
+    ]
+"""
+
+
+def test_find_related_models_separates_fk_and_m2m():
+    fk_models, implicit_m2m, through_models = find_related_models('testapp', 'Parent')
+
+    fk_pairs = {(m['model'], m['fk_field']) for m in fk_models}
+    assert ('Child', 'parent') in fk_pairs
+    assert ('WithThrough', 'parents') not in fk_pairs
+    assert ('Tagged', 'parents') not in fk_pairs
+
+    assert [(m['model'], m['field_name']) for m in through_models] == [('ParentThrough', 'parent')]
+    # M2M поля самой модели идут последними
+    assert [(m['model'], m['field_name']) for m in implicit_m2m] == [
+        ('Tagged', 'parents'),
+        ('Parent', 'others'),
+    ]
+
+
+@pytest.mark.parametrize('model_name', ['Parent', 'Other', 'Author'])
+def test_iter_implicit_m2m_matches_find_related_models(model_name):
+    model = apps.get_model('testapp', model_name)
+    _, implicit_m2m, _ = find_related_models('testapp', model_name)
+
+    assert list(_iter_implicit_m2m(apps, model)) == implicit_m2m
+    assert _any_implicit_m2m(apps, model) == bool(implicit_m2m)
+
+
+def test_create_uuid_migration_reports_implicit_m2m():
+    with pytest.raises(ValueError) as excinfo:
+        create_uuid_migration('Parent', 'testapp', dependencies=[])
+
+    message = str(excinfo.value)
+    assert "1. Модель testapp.Tagged, поле parents" in message
+    assert "2. Модель testapp.Parent, поле others" in message
+
+
+def test_create_uuid_migration_converts_fk_values():
+    Author = apps.get_model('testapp', 'Author')
+    Book = apps.get_model('testapp', 'Book')
+    with connection.schema_editor() as editor:
+        editor.create_model(Author)
+        editor.create_model(Book)
+
+    authors = [Author.objects.create(name=str(i)) for i in range(3)]
+    for i in range(7):
+        Book.objects.create(author=authors[i % 3])
+
+    Migration = create_uuid_migration('Author', 'testapp', dependencies=[])
+    migration = Migration('0002_uuid', 'testapp')
+    with connection.schema_editor() as editor:
+        migration.apply(ProjectState.from_apps(apps), editor)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT COUNT(*) FROM testapp_book b JOIN testapp_author a ON b.author_id = a.id'
+        )
+        assert cursor.fetchone() == (7,)
+
+
+class FakeCursor:
+    """
+    Курсор psycopg 3, который собирает SQL запросы и данные COPY вместо выполнения
+    """
+    def __init__(self, executed):
+        self.executed = executed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    @contextlib.contextmanager
+    def copy(self, sql):
+        data = io.StringIO()
+        yield data
+        self.executed.append((sql, data.getvalue()))
+
+
+class FakePsycopg2Cursor(FakeCursor):
+    """
+    Курсор psycopg2: данные COPY передаются через cursor.copy_expert()
+    """
+    def copy(self, sql):
+        raise AssertionError('psycopg2 has no cursor.copy()')
+
+    def copy_expert(self, sql, file):
+        self.executed.append((sql, file.read()))
+
+
+class FailingUpdateCursor(FakeCursor):
+    def execute(self, sql):
+        super().execute(sql)
+        if sql.startswith('UPDATE'):
+            raise RuntimeError('update failed')
+
+
+class FakePostgresConnection:
+    """
+    Соединение, которое выдает себя за PostgreSQL: курсор собирает SQL запросы,
+    остальные атрибуты берутся из настоящего соединения
+    """
+    vendor = 'postgresql'
+
+    def __init__(self, cursor_class):
+        self.cursor_class = cursor_class
+        self.executed = []
+
+    def __getattr__(self, name):
+        return getattr(connection, name)
+
+    def cursor(self):
+        return self.cursor_class(self.executed)
+
+
+class FakePostgresSchemaEditor:
+    """
+    Собирает SQL запросы вместо выполнения, подменяя СУБД на PostgreSQL
+    """
+    def __init__(self, cursor_class=FakeCursor):
+        self.connection = FakePostgresConnection(cursor_class)
+        self.executed = self.connection.executed
+
+    def execute(self, sql):
+        self.executed.append(sql)
+
+    def quote_name(self, name):
+        return f'"{name}"'
+
+
+def test_swap_operation_runs_single_sql_swap_on_postgresql():
+    operation = _SwapForeignKeyToUUID(
+        parent_model='Author', app_name='testapp', model_name='Book', model_app='testapp',
+        fk_field='author', pk_field='id',
+    )
+    from_state = ProjectState.from_apps(apps)
+    to_state = from_state.clone()
+    operation.state_forwards('testapp', to_state)
+    editor = FakePostgresSchemaEditor()
+
+    operation.database_forwards('testapp', editor, from_state, to_state)
+
+    assert editor.executed == _child_fk_swap_sql(
+        editor, parent_table='testapp_author', child_table='testapp_book',
+        fk_column='author_id', pk_column='id', fk_field='author', pk_field='id',
+    )
+    author = to_state.apps.get_model('testapp', 'Book')._meta.get_field('author')
+    assert isinstance(author, models.UUIDField)
+
+
+def test_generate_through_model_code_migration_hint():
+    _, migration_hints = generate_through_model_code([{
+        'model': 'Parent',
+        'app_name': 'testapp',
+        'field_name': 'others',
+        'related_model': 'Other',
+        'related_app': 'testapp',
+    }])
+
+    assert migration_hints == {'ParentOtherThrough': EXPECTED_MIGRATION_HINT}
+
+
+def test_random_uuid_bytes_sets_version_and_variant():
+    uuids = [uuid.UUID(bytes=uuid_bytes) for uuid_bytes in _random_uuid_bytes(1000)]
+
+    assert len(set(uuids)) == 1000
+    assert {u.version for u in uuids} == {4}
+    assert {u.variant for u in uuids} == {uuid.RFC_4122}
+
+
+def test_fk_uuid_update_sql():
+    editor = FakePostgresSchemaEditor()
+
+    assert _fk_uuid_update_sql(
+        editor, parent_table='app_author', child_table='app_book',
+        fk_column='author_id', pk_column='id', fk_uuid_column='author_uuid', pk_uuid_column='id_uuid',
+    ) == (
+        'UPDATE "app_book" SET "author_uuid" = p."id_uuid" '
+        'FROM "app_author" p '
+        'WHERE "app_book"."author_id" = p."id"'
+    )
+
+
+@pytest.mark.parametrize('cursor_class', [FakeCursor, FakePsycopg2Cursor])
+def test_copy_to_temp_table(cursor_class):
+    executed = []
+
+    _copy_to_temp_table(
+        FakePostgresSchemaEditor(), cursor_class(executed), 'tmp', ('pk', 'pk_uuid'), ['1\ta\n', '2\tb\n']
+    )
+
+    assert executed == [('COPY "tmp" ("pk", "pk_uuid") FROM STDIN', '1\ta\n2\tb\n')]
+
+
+@pytest.fixture
+def other_rows():
+    Other = apps.get_model('testapp', 'Other')
+    with connection.schema_editor() as editor:
+        editor.create_model(Other)
+    try:
+        yield [Other.objects.create(name=str(i)).pk for i in range(3)]
+    finally:
+        with connection.schema_editor() as editor:
+            editor.delete_model(Other)
+
+
+def test_generate_uuid_for_model_copies_uuids_on_postgresql(other_rows, monkeypatch):
+    monkeypatch.setattr(uuid_migration_utils, 'BATCH_SIZE', 2)
+    editor = FakePostgresSchemaEditor()
+
+    generate_uuid_for_model(apps, editor, model_name='Other', app_name='testapp', pk_field='id')
+
+    create, *copies, update, drop = editor.executed
+    assert create == 'CREATE TEMP TABLE "testapp_other_uuid_tmp" ("pk" integer, "pk_uuid" uuid)'
+    assert [sql for sql, _ in copies] == ['COPY "testapp_other_uuid_tmp" ("pk", "pk_uuid") FROM STDIN'] * 2
+    rows = [line.split('\t') for _, data in copies for line in data.splitlines()]
+    assert [int(pk) for pk, _ in rows] == other_rows
+    assert {uuid.UUID(uuid_hex).version for _, uuid_hex in rows} == {4}
+    assert update == (
+        'UPDATE "testapp_other" SET "id_uuid" = t."pk_uuid" '
+        'FROM "testapp_other_uuid_tmp" t '
+        'WHERE "testapp_other"."id" = t."pk"'
+    )
+    assert drop == 'DROP TABLE IF EXISTS pg_temp."testapp_other_uuid_tmp"'
+
+
+def test_generate_uuid_for_model_drops_temp_table_on_error(other_rows):
+    editor = FakePostgresSchemaEditor(FailingUpdateCursor)
+
+    with pytest.raises(RuntimeError):
+        generate_uuid_for_model(apps, editor, model_name='Other', app_name='testapp', pk_field='id')
+
+    assert editor.executed[-1] == 'DROP TABLE IF EXISTS pg_temp."testapp_other_uuid_tmp"'
+
+
+def test_child_fk_swap_sql_for_indexed_fk():
+    editor = FakePostgresSchemaEditor()
+
+    assert _child_fk_swap_sql(
+        editor, parent_table='app_author', child_table='app_book',
+        fk_column='author_id', pk_column='id', fk_field='author', pk_field='id',
+    ) == [
+        'ALTER TABLE "app_book" ADD COLUMN "author_uuid" uuid NULL',
+        'UPDATE "app_book" SET "author_uuid" = p."id_uuid" '
+        'FROM "app_author" p WHERE "app_book"."author_id" = p."id"',
+        'ALTER TABLE "app_book" DROP COLUMN "author_id"',
+        'ALTER TABLE "app_book" RENAME COLUMN "author_uuid" TO "author"',
+    ]
+
+
+def test_swap_operation_indexes_unindexed_fk_with_custom_column():
+    operation = _SwapForeignKeyToUUID(
+        parent_model='Shelf', app_name='testapp', model_name='Slot', model_app='testapp',
+        fk_field='shelf', pk_field='id',
+    )
+    from_state = ProjectState.from_apps(apps)
+    editor = FakePostgresSchemaEditor()
+
+    operation.database_forwards('testapp', editor, from_state, from_state.clone())
+
+    assert editor.executed == [
+        'ALTER TABLE "testapp_slot" ADD COLUMN "shelf_uuid" uuid NULL',
+        'CREATE INDEX IF NOT EXISTS "testapp_slot_shelf_ref_uuid_tmp" ON "testapp_slot" ("shelf_ref")',
+        'UPDATE "testapp_slot" SET "shelf_uuid" = p."id_uuid" '
+        'FROM "testapp_shelf" p WHERE "testapp_slot"."shelf_ref" = p."id"',
+        'ALTER TABLE "testapp_slot" DROP COLUMN "shelf_ref"',
+        'ALTER TABLE "testapp_slot" RENAME COLUMN "shelf_uuid" TO "shelf"',
+    ]
+
+
+def test_create_uuid_migration_reports_orphaned_not_null_fks():
+    Shelf = apps.get_model('testapp', 'Shelf')
+    Slot = apps.get_model('testapp', 'Slot')
+    with connection.schema_editor() as editor:
+        editor.create_model(Shelf)
+        editor.create_model(Slot)
+    try:
+        Slot.objects.create(shelf=Shelf.objects.create(name='shelf'))
+        with connection.constraint_checks_disabled():
+            orphans = [Slot.objects.create(shelf_id=1000 + i).pk for i in range(25)]
+
+        Migration = create_uuid_migration('Shelf', 'testapp', dependencies=[])
+        migration = Migration('0002_uuid', 'testapp')
+        with connection.schema_editor() as editor:
+            with pytest.raises(ValueError) as excinfo:
+                migration.apply(ProjectState.from_apps(apps), editor)
+            # SQLite проверяет внешние ключи при выходе из schema_editor
+            Slot.objects.filter(pk__in=orphans).delete()
+    finally:
+        with connection.schema_editor() as editor:
+            editor.delete_model(Slot)
+            editor.delete_model(Shelf)
+
+    message = str(excinfo.value)
+    assert "для 25 записей не найдена родительская запись в таблице testapp_shelf" in message
+    assert f"Первичные ключи первых из них: {orphans[:20]}." in message
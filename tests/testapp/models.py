@@ -0,0 +1,43 @@
+from django.db import models
+
+
+class Other(models.Model):
+    name = models.CharField(max_length=100)
+
+
+class Parent(models.Model):
+    name = models.CharField(max_length=100)
+    others = models.ManyToManyField(Other)
+
+
+class Child(models.Model):
+    parent = models.ForeignKey(Parent, on_delete=models.CASCADE)
+
+
+class WithThrough(models.Model):
+    parents = models.ManyToManyField(Parent, through='ParentThrough')
+
+
+class ParentThrough(models.Model):
+    parent = models.ForeignKey(Parent, on_delete=models.CASCADE)
+    with_through = models.ForeignKey(WithThrough, on_delete=models.CASCADE)
+
+
+class Tagged(models.Model):
+    parents = models.ManyToManyField(Parent)
+
+
+class Author(models.Model):
+    name = models.CharField(max_length=100)
+
+
+class Book(models.Model):
+    author = models.ForeignKey(Author, on_delete=models.CASCADE)
+
+
+class Shelf(models.Model):
+    name = models.CharField(max_length=100)
+
+
+class Slot(models.Model):
+    shelf = models.ForeignKey(Shelf, on_delete=models.CASCADE, db_column='shelf_ref', db_index=False)
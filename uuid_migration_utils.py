@@ -1,16 +1,189 @@
+import functools
+import io
+import os
 import uuid
-from django.db import migrations, models
+from django.db import migrations, models, transaction
+from django.db.backends.utils import truncate_name
+from django.db.migrations.operations.base import Operation
 from django.apps import apps as django_apps
 
+# Размер пачки при чтении и массовом обновлении записей
+BATCH_SIZE = 5000
+
+# Сколько первичных ключей записей без родителя показывать в сообщении об ошибке
+MAX_REPORTED_ORPHANS = 20
+
 def generate_uuid_for_model(apps, schema_editor, model_name, app_name, pk_field):
     """
     Генерирует UUID для основной модели
     """
     db_alias = schema_editor.connection.alias
     Model = apps.get_model(app_name, model_name)
-    for instance in Model.objects.using(db_alias).all():
-        setattr(instance, f"{pk_field}_uuid", uuid.uuid4())
-        instance.save()
+    uuid_field = f"{pk_field}_uuid"
+    
+    # На PostgreSQL загружаем UUID через COPY вместо UPDATE ... CASE WHEN от bulk_update.
+    # Целочисленные PK записываются в COPY без экранирования, поэтому путь только для них
+    if (schema_editor.connection.vendor == 'postgresql'
+            and isinstance(Model._meta.get_field(pk_field), models.IntegerField)):
+        _generate_uuid_postgresql(schema_editor, Model, pk_field)
+        return
+    
+    # Читаем записи потоково и обновляем пачками вместо save() на каждую запись
+    qs = Model.objects.using(db_alias).only(pk_field, uuid_field)
+    batch = []
+    for instance in qs.iterator(chunk_size=BATCH_SIZE):
+        batch.append(instance)
+        if len(batch) == BATCH_SIZE:
+            _update_uuid_batch(Model, batch, db_alias, uuid_field)
+            batch = []
+    
+    if batch:
+        _update_uuid_batch(Model, batch, db_alias, uuid_field)
+
+def _update_uuid_batch(Model, instances, db_alias, uuid_field):
+    """
+    Проставляет новые UUID пачке записей основной модели и сохраняет их одним bulk_update
+    """
+    for instance, uuid_bytes in zip(instances, _random_uuid_bytes(len(instances))):
+        # Пишем значение напрямую в __dict__, минуя setattr модели
+        instance.__dict__[uuid_field] = uuid.UUID(bytes=uuid_bytes)
+    
+    Model.objects.using(db_alias).bulk_update(instances, [uuid_field], batch_size=BATCH_SIZE)
+
+def _copy_to_temp_table(schema_editor, cursor, table, columns, lines):
+    """
+    Загружает строки в формате COPY (значения через табуляцию) в таблицу
+    """
+    qn = schema_editor.quote_name
+    column_list = ", ".join(qn(column) for column in columns)
+    sql = f'COPY {qn(table)} ({column_list}) FROM STDIN'
+    data = "".join(lines)
+    if hasattr(cursor, 'copy_expert'):
+        # psycopg2
+        cursor.copy_expert(sql, io.StringIO(data))
+    else:
+        # psycopg 3
+        with cursor.copy(sql) as copy:
+            copy.write(data)
+
+def _random_uuid_bytes(count):
+    """
+    Генерирует count случайных UUID версии 4 в виде 16-байтовых строк.
+    Случайные байты читаются одним вызовом os.urandom на всю пачку
+    """
+    raw = bytearray(os.urandom(16 * count))
+    for offset in range(0, len(raw), 16):
+        # Версия 4 и вариант RFC 4122, как в uuid.uuid4()
+        raw[offset + 6] = (raw[offset + 6] & 0x0F) | 0x40
+        raw[offset + 8] = (raw[offset + 8] & 0x3F) | 0x80
+    raw = bytes(raw)
+    return [raw[offset:offset + 16] for offset in range(0, len(raw), 16)]
+
+def _random_uuid_hexes(count):
+    """
+    Генерирует count случайных UUID версии 4 в виде hex строк, без создания объектов uuid.UUID
+    """
+    return [uuid_bytes.hex() for uuid_bytes in _random_uuid_bytes(count)]
+
+def _copy_uuid_batch(schema_editor, cursor, tmp_table, pk_batch):
+    """
+    Загружает пачку первичных ключей со сгенерированными UUID во временную таблицу
+    """
+    lines = [
+        f"{pk_value}\t{uuid_hex}\n"
+        for pk_value, uuid_hex in zip(pk_batch, _random_uuid_hexes(len(pk_batch)))
+    ]
+    _copy_to_temp_table(schema_editor, cursor, tmp_table, ('pk', 'pk_uuid'), lines)
+
+def _generate_uuid_postgresql(schema_editor, Model, pk_field):
+    """
+    Генерирует UUID для основной модели на PostgreSQL: пары (pk, uuid) загружаются
+    через COPY во временную таблицу и переносятся одним UPDATE ... FROM
+    """
+    db_connection = schema_editor.connection
+    qn = schema_editor.quote_name
+    table = Model._meta.db_table
+    pk = Model._meta.get_field(pk_field)
+    uuid_column = f"{pk_field}_uuid"
+    # Имя временной таблицы строим от имени основной, чтобы миграции разных моделей не пересекались
+    tmp_table = truncate_name(f"{table}_uuid_tmp", db_connection.ops.max_name_length())
+    
+    pks = Model.objects.using(db_connection.alias).values_list(pk_field, flat=True)
+    try:
+        # При ошибке atomic откатывает изменения до точки сохранения, и соединение
+        # остается пригодным для удаления временной таблицы в finally
+        with transaction.atomic(using=db_connection.alias), db_connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMP TABLE {qn(tmp_table)} '
+                f'({qn("pk")} {pk.rel_db_type(db_connection)}, {qn("pk_uuid")} uuid)'
+            )
+            
+            pk_batch = []
+            for pk_value in pks.iterator(chunk_size=BATCH_SIZE):
+                pk_batch.append(pk_value)
+                if len(pk_batch) == BATCH_SIZE:
+                    _copy_uuid_batch(schema_editor, cursor, tmp_table, pk_batch)
+                    pk_batch = []
+            
+            if pk_batch:
+                _copy_uuid_batch(schema_editor, cursor, tmp_table, pk_batch)
+            
+            cursor.execute(
+                f'UPDATE {qn(table)} SET {qn(uuid_column)} = t.{qn("pk_uuid")} '
+                f'FROM {qn(tmp_table)} t '
+                f'WHERE {qn(table)}.{qn(pk.column)} = t.{qn("pk")}'
+            )
+    finally:
+        # Удаляем только временную таблицу из схемы pg_temp, а не одноименную постоянную
+        with db_connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS pg_temp.{qn(tmp_table)}')
+
+def _fk_uuid_update_sql(schema_editor, parent_table, child_table, fk_column, pk_column, fk_uuid_column, pk_uuid_column):
+    """
+    Возвращает SQL, который переносит UUID родителя в UUID колонку дочерней таблицы
+    """
+    qn = schema_editor.quote_name
+    return (
+        f'UPDATE {qn(child_table)} SET {qn(fk_uuid_column)} = p.{qn(pk_uuid_column)} '
+        f'FROM {qn(parent_table)} p '
+        f'WHERE {qn(child_table)}.{qn(fk_column)} = p.{qn(pk_column)}'
+    )
+
+def _child_fk_swap_sql(schema_editor, parent_table, child_table, fk_column, pk_column, fk_field, pk_field,
+                       fk_indexed=True):
+    """
+    Возвращает SQL для PostgreSQL, который заменяет целочисленный FK дочерней таблицы на UUID:
+    добавляет UUID колонку, заполняет ее, удаляет старую колонку и переименовывает новую
+    """
+    qn = schema_editor.quote_name
+    fk_uuid_column = f"{fk_field}_uuid"
+    statements = [
+        f'ALTER TABLE {qn(child_table)} ADD COLUMN {qn(fk_uuid_column)} uuid NULL',
+    ]
+    
+    # Если FK объявлен без индекса, временно индексируем его для соединения с родителем.
+    # Индекс удаляется вместе со старой колонкой
+    if not fk_indexed:
+        tmp_index = f"{child_table}_{fk_column}_uuid_tmp"
+        statements.append(
+            f'CREATE INDEX IF NOT EXISTS {qn(tmp_index)} '
+            f'ON {qn(child_table)} ({qn(fk_column)})'
+        )
+    
+    statements += [
+        _fk_uuid_update_sql(
+            schema_editor,
+            parent_table=parent_table,
+            child_table=child_table,
+            fk_column=fk_column,
+            pk_column=pk_column,
+            fk_uuid_column=fk_uuid_column,
+            pk_uuid_column=f"{pk_field}_uuid",
+        ),
+        f'ALTER TABLE {qn(child_table)} DROP COLUMN {qn(fk_column)}',
+        f'ALTER TABLE {qn(child_table)} RENAME COLUMN {qn(fk_uuid_column)} TO {qn(fk_field)}',
+    ]
+    return statements
 
 def update_foreign_keys(apps, schema_editor, parent_model, child_model, app_name, child_app_name, fk_field, pk_field):
     """
@@ -20,150 +193,250 @@ def update_foreign_keys(apps, schema_editor, parent_model, child_model, app_name
     ParentModel = apps.get_model(app_name, parent_model)
     ChildModel = apps.get_model(child_app_name, child_model)
     
-    for child in ChildModel.objects.using(db_alias).all():
-        try:
-            parent_instance = ParentModel.objects.get(**{f"{pk_field}": getattr(child, f"{fk_field}_id")})
-            setattr(child, f"{fk_field}_uuid", getattr(parent_instance, f"{pk_field}_uuid"))
-            child.save()
-        except ParentModel.DoesNotExist:
-            # Обработка случая, когда родительский объект не существует
-            # Например, если FK допускает null, можно установить None
-            if ChildModel._meta.get_field(fk_field).null:
-                setattr(child, f"{fk_field}_uuid", None)
-                child.save()
+    # На PostgreSQL переносим UUID одним UPDATE ... FROM на стороне БД.
+    # Строки с NULL в FK не совпадают по условию соединения и остаются NULL
+    if schema_editor.connection.vendor == 'postgresql':
+        sql = _fk_uuid_update_sql(
+            schema_editor,
+            parent_table=ParentModel._meta.db_table,
+            child_table=ChildModel._meta.db_table,
+            fk_column=ChildModel._meta.get_field(fk_field).column,
+            pk_column=ParentModel._meta.get_field(pk_field).column,
+            fk_uuid_column=f"{fk_field}_uuid",
+            pk_uuid_column=f"{pk_field}_uuid",
+        )
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(sql)
+        return
+    
+    # Читаем только нужные колонки и потоково, чтобы не держать всю таблицу в памяти
+    children = ChildModel.objects.using(db_alias).only(
+        ChildModel._meta.pk.name, fk_field, f"{fk_field}_uuid"
+    )
+    # Новая UUID колонка уже NULL, поэтому строки с пустым FK обрабатывать не нужно
+    fk_nullable = ChildModel._meta.get_field(fk_field).null
+    if fk_nullable:
+        children = children.filter(**{f"{fk_field}__isnull": False})
+    batch = []
+    for child in children.iterator(chunk_size=BATCH_SIZE):
+        batch.append(child)
+        if len(batch) == BATCH_SIZE:
+            _update_fk_uuid_batch(ParentModel, ChildModel, batch, db_alias, fk_field, pk_field, fk_nullable)
+            batch = []
+    
+    if batch:
+        _update_fk_uuid_batch(ParentModel, ChildModel, batch, db_alias, fk_field, pk_field, fk_nullable)
 
-def find_related_models(app_name, parent_model, apps_registry=None):
+def _update_fk_uuid_batch(ParentModel, ChildModel, children, db_alias, fk_field, pk_field, fk_nullable):
     """
-    Автоматически находит все модели, которые имеют отношения к указанной модели
+    Проставляет UUID родителя пачке дочерних записей одним SELECT и одним bulk_update.
+    Если FK не допускает NULL, а родитель не найден, выбрасывает ValueError
+    """
+    fk_attname = ChildModel._meta.get_field(fk_field).attname
+    fk_uuid_field = f"{fk_field}_uuid"
     
-    Возвращает:
-    - fk_models: список словарей с информацией о моделях с ForeignKey
-    - implicit_m2m: список словарей с информацией о неявных M2M отношениях
-    - through_models: список словарей с информацией о M2M через модели
+    # Значения полей читаем и пишем напрямую через __dict__, минуя дескрипторы модели.
+    # Загружаем UUID всех родителей пачки одним запросом WHERE ... IN
+    fk_ids = {child.__dict__[fk_attname] for child in children}
+    parent_uuids = dict(
+        ParentModel.objects.using(db_alias)
+        .filter(**{f"{pk_field}__in": fk_ids})
+        .values_list(pk_field, f"{pk_field}_uuid")
+    )
+    
+    # Если родитель не найден, UUID остается NULL и строку не обновляем
+    changed = []
+    orphans = []
+    for child in children:
+        parent_uuid = parent_uuids.get(child.__dict__[fk_attname])
+        if parent_uuid is not None:
+            child.__dict__[fk_uuid_field] = parent_uuid
+            changed.append(child)
+        else:
+            orphans.append(child.pk)
+    
+    # Для NOT NULL FK запись без родителя не сможет пройти миграцию, сообщаем об этом сразу.
+    # Общее число таких записей считаем одним запросом, а ключи показываем только первые
+    if orphans and not fk_nullable:
+        orphans_total = (
+            ChildModel.objects.using(db_alias)
+            .exclude(**{f"{fk_attname}__in": ParentModel.objects.using(db_alias).values(pk_field)})
+            .count()
+        )
+        raise ValueError(
+            f"Таблица {ChildModel._meta.db_table}: поле {fk_field} не допускает NULL, "
+            f"но для {orphans_total} записей не найдена родительская запись "
+            f"в таблице {ParentModel._meta.db_table}. "
+            f"Первичные ключи первых из них: {orphans[:MAX_REPORTED_ORPHANS]}. "
+            f"Исправьте или удалите эти записи перед миграцией."
+        )
+    
+    if changed:
+        ChildModel.objects.using(db_alias).bulk_update(changed, [fk_uuid_field], batch_size=BATCH_SIZE)
+
+def _build_relation_index(apps_registry):
     """
-    if apps_registry is None:
-        apps_registry = django_apps
-        
-    fk_models = []
-    implicit_m2m = []
-    through_models = []
+    Один раз обходит реестр приложений и строит индекс отношений
     
-    # Получаем модель, для которой ищем зависимости
-    parent_model_obj = apps_registry.get_model(app_name, parent_model)
+    Возвращает словарь {модель: отношения}, где для каждой модели собраны все отношения,
+    которые на нее ссылаются. M2M поля, объявленные в самой модели, хранятся отдельно
+    (own_implicit_m2m, own_through_models), чтобы find_related_models возвращал их последними
+    """
+    index = {}
+    
+    def relations_to(model):
+        if model not in index:
+            index[model] = {
+                'fk_models': [],
+                'implicit_m2m': [],
+                'through_models': [],
+                'own_implicit_m2m': [],
+                'own_through_models': [],
+            }
+        return index[model]
     
     # Проходим по всем моделям во всех приложениях
     for model in apps_registry.get_models():
-        # Для каждой модели проверяем все поля
-        for field in model._meta.fields:
-            # Проверяем, является ли поле ForeignKey, ссылающимся на нашу модель
-            if field.is_relation and field.related_model == parent_model_obj:
-                fk_models.append({
+        # Проверяем все поля модели за один проход
+        for field in model._meta.get_fields(include_hidden=False):
+            # ForeignKey попадает в индекс модели, на которую он ссылается.
+            # M2M поля тоже concrete, поэтому исключаем их явно
+            if field.concrete and field.is_relation and not field.many_to_many:
+                relations_to(field.related_model)['fk_models'].append({
                     'model': model._meta.object_name,
                     'app_name': model._meta.app_label,
                     'fk_field': field.name
                 })
-        
-        # Проверяем M2M поля в других моделях
-        for field in model._meta.many_to_many:
-            if field.related_model == parent_model_obj:
-                # Проверяем, использует ли поле промежуточную модель (through)
-                if field.remote_field.through._meta.auto_created:
-                    # Автоматически созданная (неявная) M2M модель
-                    implicit_m2m.append({
-                        'model': model._meta.object_name,
-                        'app_name': model._meta.app_label,
-                        'field_name': field.name
+                continue
+            
+            # Кроме ForeignKey нас интересуют только объявленные в модели M2M поля,
+            # обратные связи пропускаем
+            if not field.many_to_many or field.auto_created:
+                continue
+            
+            # M2M поле относится и к модели, на которую оно ссылается, и к модели, в которой объявлено
+            target_model = field.related_model
+            target_relations = relations_to(target_model)
+            own_relations = relations_to(model)
+            
+            # Проверяем, использует ли поле промежуточную модель (through)
+            if field.remote_field.through._meta.auto_created:
+                # Автоматически созданная (неявная) M2M модель
+                target_relations['implicit_m2m'].append({
+                    'model': model._meta.object_name,
+                    'app_name': model._meta.app_label,
+                    'field_name': field.name
+                })
+                # Неявная M2M модель в самой модели
+                own_relations['own_implicit_m2m'].append({
+                    'model': model._meta.object_name,
+                    'app_name': model._meta.app_label,
+                    'field_name': field.name,
+                    'related_model': target_model._meta.object_name,
+                    'related_app': target_model._meta.app_label
+                })
+                continue
+            
+            # Явно определенная through модель
+            through_model = field.remote_field.through
+            # Один раз собираем поля-отношения through модели и раскладываем их по группам
+            rel_fields = [f for f in through_model._meta.fields if f.is_relation]
+            to_target = [f.name for f in rel_fields if f.related_model is target_model]
+            to_own = [f.name for f in rel_fields if f.related_model is model]
+            to_other = [f.name for f in rel_fields if f.related_model is not model]
+            
+            # Поля through модели, которые ссылаются на целевую модель
+            for through_field_name in to_target:
+                target_relations['through_models'].append({
+                    'model': through_model._meta.object_name,
+                    'app_name': through_model._meta.app_label,
+                    'field_name': through_field_name
+                })
+            
+            # Поля, которые ссылаются на саму модель, если through связывает ее с другой моделью
+            if to_other:
+                for through_field_name in to_own:
+                    own_relations['own_through_models'].append({
+                        'model': through_model._meta.object_name,
+                        'app_name': through_model._meta.app_label,
+                        'field_name': through_field_name
                     })
-                else:
-                    # Явно определенная through модель
-                    through_model = field.remote_field.through
-                    # Находим поле в through модели, которое ссылается на нашу родительскую модель
-                    for through_field in through_model._meta.fields:
-                        if through_field.is_relation and through_field.related_model == parent_model_obj:
-                            through_models.append({
-                                'model': through_model._meta.object_name,
-                                'app_name': through_model._meta.app_label,
-                                'field_name': through_field.name
-                            })
-    
-    # Проверяем M2M поля в самой родительской модели
+    
+    return index
+
+def _iter_implicit_m2m(apps_registry, parent_model_obj):
+    """
+    Перечисляет неявные M2M отношения указанной модели, просматривая только M2M поля.
+    Элементы и их порядок совпадают с implicit_m2m из find_related_models:
+    сначала поля других моделей, затем поля самой модели
+    """
+    # Неявные M2M поля, которые ссылаются на нашу модель
+    for model in apps_registry.get_models():
+        for field in model._meta.many_to_many:
+            if field.related_model is parent_model_obj and field.remote_field.through._meta.auto_created:
+                yield {
+                    'model': model._meta.object_name,
+                    'app_name': model._meta.app_label,
+                    'field_name': field.name
+                }
+    
+    # Неявные M2M поля в самой модели
     for field in parent_model_obj._meta.many_to_many:
         if field.remote_field.through._meta.auto_created:
-            # Автоматически созданная (неявная) M2M модель в нашей модели
-            implicit_m2m.append({
-                'model': parent_model,
-                'app_name': app_name,
+            yield {
+                'model': parent_model_obj._meta.object_name,
+                'app_name': parent_model_obj._meta.app_label,
                 'field_name': field.name,
                 'related_model': field.related_model._meta.object_name,
                 'related_app': field.related_model._meta.app_label
-            })
-        else:
-            # Явно определенная through модель в нашей модели
-            through_model = field.remote_field.through
-            # Находим поле в through модели, которое ссылается на другую модель
-            for through_field in through_model._meta.fields:
-                if through_field.is_relation and through_field.related_model != parent_model_obj:
-                    # Это поле ссылается на другую модель
-                    related_model_field = through_field.name
-                    # Находим поле, которое ссылается на нашу модель
-                    for other_field in through_model._meta.fields:
-                        if (other_field.is_relation and 
-                            other_field.related_model == parent_model_obj and
-                            other_field.name != through_field.name):
-                            # Нашли поле, которое ссылается на нашу модель
-                            parent_model_field = other_field.name
-                            through_models.append({
-                                'model': through_model._meta.object_name,
-                                'app_name': through_model._meta.app_label,
-                                'field_name': parent_model_field
-                            })
-    
-    return fk_models, implicit_m2m, through_models
+            }
 
-def generate_through_model_code(implicit_m2m):
+def _any_implicit_m2m(apps_registry, parent_model_obj):
     """
-    Генерирует код для through моделей на основе неявных M2M отношений
+    Проверяет, есть ли у модели неявные M2M отношения, останавливаясь на первом найденном
     """
-    through_models_code = {}
-    migration_hints = {}
+    return next(_iter_implicit_m2m(apps_registry, parent_model_obj), None) is not None
+
+def find_related_models(app_name, parent_model, apps_registry=None):
+    """
+    Автоматически находит все модели, которые имеют отношения к указанной модели
     
-    for m2m in implicit_m2m:
-        source_model = m2m['model']
-        source_app = m2m['app_name']
-        field_name = m2m['field_name']
-        
-        # Если это M2M в нашей модели
-        if 'related_model' in m2m:
-            target_model = m2m['related_model']
-            target_app = m2m['related_app']
-        else:
-            # Если это M2M в другой модели, целью которого является наша модель
-            target_model = m2m['model']
-            target_app = m2m['app_name']
-            source_model = m2m.get('related_model', source_model)
-            source_app = m2m.get('related_app', source_app)
-        
-        # Генерируем имя для новой through модели
-        through_model_name = f"{source_model}{target_model}Through"
-        
-        # Прогнозируем имя автоматически созданной M2M таблицы Django
-        automatic_table_name = f"{source_app.lower()}_{source_model.lower()}_{field_name.lower()}"
-        
-        # Генерируем код модели с учетом предупреждений линтера
-        model_code = f"""
+    Возвращает:
+    - fk_models: список словарей с информацией о моделях с ForeignKey
+    - implicit_m2m: список словарей с информацией о неявных M2M отношениях
+    - through_models: список словарей с информацией о M2M через модели
+    """
+    if apps_registry is None:
+        apps_registry = django_apps
+    
+    # Получаем модель, для которой ищем зависимости
+    parent_model_obj = apps_registry.get_model(app_name, parent_model)
+    
+    relations = _build_relation_index(apps_registry).get(parent_model_obj)
+    if relations is None:
+        return [], [], []
+    
+    # M2M поля самой модели идут после отношений из других моделей
+    fk_models = list(relations['fk_models'])
+    implicit_m2m = relations['implicit_m2m'] + relations['own_implicit_m2m']
+    through_models = relations['through_models'] + relations['own_through_models']
+    return fk_models, implicit_m2m, through_models
+
+# Шаблон кода through модели для замены неявной M2M связи
+_THROUGH_MODEL_TPL = """
 class {through_model_name}(models.Model):
-    {source_model.lower()} = models.ForeignKey('{source_app}.{source_model}', on_delete=models.CASCADE, db_index=True)
-    {target_model.lower()} = models.ForeignKey('{target_app}.{target_model}', on_delete=models.CASCADE, db_index=True)
+    {source_lc} = models.ForeignKey('{source_app}.{source_model}', on_delete=models.CASCADE, db_index=True)
+    {target_lc} = models.ForeignKey('{target_app}.{target_model}', on_delete=models.CASCADE, db_index=True)
     # Дополнительные поля здесь
     
     class Meta:
         constraints = [
-            models.UniqueConstraint(fields=['{source_model.lower()}', '{target_model.lower()}'], name='unique_{source_model.lower()}_{target_model.lower()}')
+            models.UniqueConstraint(fields=['{source_lc}', '{target_lc}'], name='unique_{source_lc}_{target_lc}')
         ]
 """
-        
-        # Генерируем подсказку для миграционного файла
-        migration_hint = f"""
+
+# Шаблон миграции, которая переводит неявную M2M связь на through модель
+_MIGRATION_HINT_TPL = """
 # ВАЖНО: Простое изменение модели и создание обычной миграции НЕ СРАБОТАЕТ
 # Вместо этого после создания through-модели {through_model_name}:
 # 1. Создайте миграцию: python manage.py makemigrations
@@ -183,19 +456,19 @@ class Migration(migrations.Migration):
             name='{through_model_name}',
             fields=[
                 ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
-                ('{source_model.lower()}', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='{source_app}.{source_model}', db_index=True)),
-                ('{target_model.lower()}', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='{target_app}.{target_model}', db_index=True)),
+                ('{source_lc}', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='{source_app}.{source_model}', db_index=True)),
+                ('{target_lc}', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='{target_app}.{target_model}', db_index=True)),
                 # Дополнительные поля модели здесь
             ],
         ),
         # Указываем Django использовать существующую таблицу для новой модели
         migrations.AlterModelTable(
-            name='{through_model_name.lower()}',
+            name='{through_lc}',
             table='{automatic_table_name}',  # Имя автоматически созданной m2m таблицы
         ),
         # Меняем состояние модели для использования through
         migrations.AlterField(
-            model_name='{source_model.lower()}',
+            model_name='{source_lc}',
             name='{field_name}',
             field=models.ManyToManyField(through='{source_app}.{through_model_name}', to='{target_app}.{target_model}'),
         ),
@@ -212,17 +485,157 @@ class Migration(migrations.Migration):
         # ),
         # Возвращаем имя таблицы в нормальное состояние
         migrations.AlterModelTable(
-            name='{through_model_name.lower()}',
+            name='{through_lc}',
             table=None,
         ),
     ]
 """
+
+def generate_through_model_code(implicit_m2m):
+    """
+    Генерирует код для through моделей на основе неявных M2M отношений
+    """
+    through_models_code = {}
+    migration_hints = {}
+    
+    for m2m in implicit_m2m:
+        source_model = m2m['model']
+        source_app = m2m['app_name']
+        field_name = m2m['field_name']
+        
+        # Если это M2M в нашей модели
+        if 'related_model' in m2m:
+            target_model = m2m['related_model']
+            target_app = m2m['related_app']
+        else:
+            # Если это M2M в другой модели, целью которого является наша модель
+            target_model = m2m['model']
+            target_app = m2m['app_name']
+            source_model = m2m.get('related_model', source_model)
+            source_app = m2m.get('related_app', source_app)
+        
+        # Генерируем имя для новой through модели
+        through_model_name = f"{source_model}{target_model}Through"
+        
+        # Прогнозируем имя автоматически созданной M2M таблицы Django
+        automatic_table_name = f"{source_app.lower()}_{source_model.lower()}_{field_name.lower()}"
+        
+        ctx = {
+            'source_model': source_model,
+            'source_app': source_app,
+            'source_lc': source_model.lower(),
+            'target_model': target_model,
+            'target_app': target_app,
+            'target_lc': target_model.lower(),
+            'field_name': field_name,
+            'through_model_name': through_model_name,
+            'through_lc': through_model_name.lower(),
+            'automatic_table_name': automatic_table_name,
+        }
+        
+        # Генерируем код модели с учетом предупреждений линтера
+        model_code = _THROUGH_MODEL_TPL.format_map(ctx)
+        
+        # Генерируем подсказку для миграционного файла
+        migration_hint = _MIGRATION_HINT_TPL.format_map(ctx)
         
         through_models_code[through_model_name] = model_code
         migration_hints[through_model_name] = migration_hint
     
     return through_models_code, migration_hints
 
+class _SwapForeignKeyToUUID(Operation):
+    """
+    Операция миграции, которая заменяет целочисленный FK модели на UUID колонку
+    с UUID родителя. Поле сохраняет исходное имя.
+    СУБД определяется при выполнении миграции: на PostgreSQL замена идет набором SQL
+    запросов, на остальных БД применяются обычные операции миграции
+    """
+    reversible = False
+    reduces_to_sql = False
+    
+    def __init__(self, parent_model, app_name, model_name, model_app, fk_field, pk_field):
+        self.parent_model = parent_model
+        self.app_name = app_name
+        self.model_name = model_name
+        self.model_app = model_app
+        self.fk_field = fk_field
+        self.pk_field = pk_field
+        
+        model_lc = model_name.lower()
+        fk_uuid_name = f"{fk_field}_uuid"
+        self.state_operations = [
+            # 1. Добавляем UUID поле в модель
+            migrations.AddField(
+                model_name=model_lc,
+                name=fk_uuid_name,
+                field=models.UUIDField(null=True),
+            ),
+            # 2. Удаляем старое FK поле
+            migrations.RemoveField(
+                model_name=model_lc,
+                name=fk_field,
+            ),
+            # 3. Переименовываем UUID поле в оригинальное имя FK
+            migrations.RenameField(
+                model_name=model_lc,
+                old_name=fk_uuid_name,
+                new_name=fk_field,
+            ),
+        ]
+        # На остальных БД между добавлением UUID поля и удалением старого FK
+        # переносим значения UUID из родительской модели
+        self.database_operations = [
+            self.state_operations[0],
+            migrations.RunPython(
+                functools.partial(
+                    update_foreign_keys,
+                    parent_model=parent_model, child_model=model_name,
+                    app_name=app_name, child_app_name=model_app,
+                    fk_field=fk_field, pk_field=pk_field,
+                )
+            ),
+            *self.state_operations[1:],
+        ]
+    
+    def state_forwards(self, app_label, state):
+        for operation in self.state_operations:
+            operation.state_forwards(app_label, state)
+    
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            self._swap_postgresql(schema_editor, from_state)
+            return
+        
+        # Применяем операции по цепочке состояний, начиная с переданного исполнителем миграций,
+        # как это делает SeparateDatabaseAndState
+        for operation in self.database_operations:
+            next_state = from_state.clone()
+            operation.state_forwards(app_label, next_state)
+            operation.database_forwards(app_label, schema_editor, from_state, next_state)
+            from_state = next_state
+    
+    def _swap_postgresql(self, schema_editor, from_state):
+        # Имена таблиц и колонок берем из состояния миграции, а не из текущих моделей проекта
+        ParentModel = from_state.apps.get_model(self.app_name, self.parent_model)
+        ChildModel = from_state.apps.get_model(self.model_app, self.model_name)
+        fk = ChildModel._meta.get_field(self.fk_field)
+        statements = _child_fk_swap_sql(
+            schema_editor,
+            parent_table=ParentModel._meta.db_table,
+            child_table=ChildModel._meta.db_table,
+            fk_column=fk.column,
+            pk_column=ParentModel._meta.get_field(self.pk_field).column,
+            fk_field=self.fk_field,
+            pk_field=self.pk_field,
+            fk_indexed=fk.db_index or fk.unique,
+        )
+        for sql in statements:
+            schema_editor.execute(sql)
+    
+    def describe(self):
+        return f"Swap {self.model_name}.{self.fk_field} to {self.parent_model} UUID"
+
 def create_uuid_migration(parent_model, app_name, dependencies, child_models=None, pk_field='id', auto_detect_relations=True):
     """
     Создает миграцию для преобразования целочисленного PK в UUID
@@ -240,36 +653,38 @@ def create_uuid_migration(parent_model, app_name, dependencies, child_models=Non
     
     # Автоматическое определение связанных моделей
     if auto_detect_relations:
-        fk_related, implicit_m2m, through_models = find_related_models(app_name, parent_model)
+        # Сначала проверяем только M2M поля: при неявных M2M полный индекс отношений не нужен
+        parent_model_obj = django_apps.get_model(app_name, parent_model)
         
         # Проверяем наличие неявных M2M и выдаем ошибку с рекомендациями
-        if implicit_m2m:
+        if _any_implicit_m2m(django_apps, parent_model_obj):
+            implicit_m2m = list(_iter_implicit_m2m(django_apps, parent_model_obj))
             through_models_code, migration_hints = generate_through_model_code(implicit_m2m)
-            error_message = (
+            error_parts = [
                 f"Обнаружены неявные M2M отношения для модели {parent_model}. "
                 "Перед миграцией на UUID необходимо заменить их на явные through модели.\n\n"
                 "Найдены следующие неявные M2M отношения:\n"
-            )
+            ]
             
             for i, m2m in enumerate(implicit_m2m):
                 model = m2m['model']
                 field = m2m['field_name']
                 app = m2m['app_name']
-                error_message += f"{i+1}. Модель {app}.{model}, поле {field}\n"
+                error_parts.append(f"{i+1}. Модель {app}.{model}, поле {field}\n")
             
-            error_message += "\n---------МОДЕЛИ THROUGH---------\n"
-            error_message += "Создайте следующие through модели:\n\n"
+            error_parts.append("\n---------МОДЕЛИ THROUGH---------\n")
+            error_parts.append("Создайте следующие through модели:\n\n")
             
             for through_name, code in through_models_code.items():
-                error_message += f"# Модель {through_name}:\n{code}\n"
+                error_parts.append(f"# Модель {through_name}:\n{code}\n")
             
-            error_message += "\n---------МИГРАЦИОННЫЕ ФАЙЛЫ---------\n"
-            error_message += "ВАЖНО: Простое изменение модели не сработает! Необходимо использовать специальную технику миграции:\n\n"
+            error_parts.append("\n---------МИГРАЦИОННЫЕ ФАЙЛЫ---------\n")
+            error_parts.append("ВАЖНО: Простое изменение модели не сработает! Необходимо использовать специальную технику миграции:\n\n")
             
             for through_name, hint in migration_hints.items():
-                error_message += f"# Миграция для {through_name}:\n{hint}\n"
+                error_parts.append(f"# Миграция для {through_name}:\n{hint}\n")
                 
-            error_message += (
+            error_parts.append(
                 "\n---------ПОСЛЕ МИГРАЦИИ---------\n"
                 "После создания through моделей и применения миграции, обновите ваши модели, заменив:\n"
                 "tags = models.ManyToManyField(Tag)\n\n"
@@ -278,7 +693,9 @@ def create_uuid_migration(parent_model, app_name, dependencies, child_models=Non
                 "Только после этого запустите миграцию UUID."
             )
             
-            raise ValueError(error_message)
+            raise ValueError("".join(error_parts))
+        
+        fk_related, _, through_models = find_related_models(app_name, parent_model)
         
         # Если child_models не указаны явно, используем найденные
         if child_models is None:
@@ -288,11 +705,14 @@ def create_uuid_migration(parent_model, app_name, dependencies, child_models=Non
     if child_models is None:
         child_models = []
     
+    parent_lc = parent_model.lower()
+    pk_uuid_name = f"{pk_field}_uuid"
+    
     # 1. Добавляем UUID поле в родительскую модель
     operations.append(
         migrations.AddField(
-            model_name=parent_model.lower(),
-            name=f"{pk_field}_uuid",
+            model_name=parent_lc,
+            name=pk_uuid_name,
             field=models.UUIDField(null=True),
         )
     )
@@ -300,8 +720,9 @@ def create_uuid_migration(parent_model, app_name, dependencies, child_models=Non
     # 2. Генерируем UUID для каждой записи в родительской модели
     operations.append(
         migrations.RunPython(
-            lambda apps, schema_editor: generate_uuid_for_model(
-                apps, schema_editor, parent_model, app_name, pk_field
+            functools.partial(
+                generate_uuid_for_model,
+                model_name=parent_model, app_name=app_name, pk_field=pk_field,
             )
         )
     )
@@ -309,8 +730,8 @@ def create_uuid_migration(parent_model, app_name, dependencies, child_models=Non
     # 3. Обновляем UUID поле (делаем его обязательным и не редактируемым)
     operations.append(
         migrations.AlterField(
-            model_name=parent_model.lower(),
-            name=f"{pk_field}_uuid",
+            model_name=parent_lc,
+            name=pk_uuid_name,
             field=models.UUIDField(default=uuid.uuid4, editable=False, serialize=False),
         )
     )
@@ -318,92 +739,34 @@ def create_uuid_migration(parent_model, app_name, dependencies, child_models=Non
     # 4. Обрабатываем through модели если они есть и автоопределение включено
     if auto_detect_relations and through_models:
         for through in through_models:
-            through_model = through['model']
-            field_name = through['field_name']
-            through_app = through.get('app_name', app_name)
-            
-            # 4.1. Добавляем UUID поле в through модель
-            operations.append(
-                migrations.AddField(
-                    model_name=through_model.lower(),
-                    name=f"{field_name}_uuid",
-                    field=models.UUIDField(null=True),
-                )
-            )
-            
-            # 4.2. Обновляем UUID в through модели
-            operations.append(
-                migrations.RunPython(
-                    lambda apps, schema_editor: update_foreign_keys(
-                        apps, schema_editor, parent_model, through_model, 
-                        app_name, through_app, field_name, pk_field
-                    )
-                )
-            )
-            
-            # 4.3. Удаляем старое поле
             operations.append(
-                migrations.RemoveField(
-                    model_name=through_model.lower(),
-                    name=field_name,
-                )
-            )
-            
-            # 4.4. Переименовываем UUID поле
-            operations.append(
-                migrations.RenameField(
-                    model_name=through_model.lower(),
-                    old_name=f"{field_name}_uuid",
-                    new_name=field_name,
+                _SwapForeignKeyToUUID(
+                    parent_model=parent_model,
+                    app_name=app_name,
+                    model_name=through['model'],
+                    model_app=through.get('app_name', app_name),
+                    fk_field=through['field_name'],
+                    pk_field=pk_field,
                 )
             )
     
     # 5. Для каждой дочерней модели создаем соответствующие операции
     for child in child_models:
-        child_model = child['model']
-        fk_field = child['fk_field']
-        child_app = child.get('app_name', app_name)
-        
-        # 5.1. Добавляем UUID поле в дочернюю модель
         operations.append(
-            migrations.AddField(
-                model_name=child_model.lower(),
-                name=f"{fk_field}_uuid",
-                field=models.UUIDField(null=True),
-            )
-        )
-        
-        # 5.2. Обновляем значения UUID в дочерней модели на основе родительской
-        operations.append(
-            migrations.RunPython(
-                lambda apps, schema_editor: update_foreign_keys(
-                    apps, schema_editor, parent_model, child_model, 
-                    app_name, child_app, fk_field, pk_field
-                )
-            )
-        )
-        
-        # 5.3. Удаляем старое FK поле
-        operations.append(
-            migrations.RemoveField(
-                model_name=child_model.lower(),
-                name=fk_field,
-            )
-        )
-        
-        # 5.4. Переименовываем UUID поле в оригинальное имя FK
-        operations.append(
-            migrations.RenameField(
-                model_name=child_model.lower(),
-                old_name=f"{fk_field}_uuid",
-                new_name=fk_field,
+            _SwapForeignKeyToUUID(
+                parent_model=parent_model,
+                app_name=app_name,
+                model_name=child['model'],
+                model_app=child.get('app_name', app_name),
+                fk_field=child['fk_field'],
+                pk_field=pk_field,
             )
         )
     
     # 6. Удаляем старый PK из родительской модели
     operations.append(
         migrations.RemoveField(
-            model_name=parent_model.lower(),
+            model_name=parent_lc,
             name=pk_field,
         )
     )
@@ -411,8 +774,8 @@ def create_uuid_migration(parent_model, app_name, dependencies, child_models=Non
     # 7. Переименовываем UUID поле в оригинальное имя PK
     operations.append(
         migrations.RenameField(
-            model_name=parent_model.lower(),
-            old_name=f"{pk_field}_uuid",
+            model_name=parent_lc,
+            old_name=pk_uuid_name,
             new_name=pk_field,
         )
     )
@@ -420,7 +783,7 @@ def create_uuid_migration(parent_model, app_name, dependencies, child_models=Non
     # 8. Устанавливаем новое поле как primary_key
     operations.append(
         migrations.AlterField(
-            model_name=parent_model.lower(),
+            model_name=parent_lc,
             name=pk_field,
             field=models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False),
         )